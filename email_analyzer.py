@@ -2,31 +2,164 @@
 """
 Email Analyzer: Fetches unread emails from Gmail and categorizes them.
 """
+import argparse
+import asyncio
+import json
 import os
-import pickle
+import random
 import re
+import shutil
+import sqlite3
+import tempfile
 import time
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Tuple
 import base64
 import webbrowser
 import csv
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.cluster import KMeans
+import httplib2
+import numpy as np
+import pandas as pd
+import threading
+from contextlib import ExitStack, closing
+from concurrent.futures import ThreadPoolExecutor
+from scipy.sparse import csr_matrix
+from sklearn.feature_extraction.text import CountVectorizer, TfidfTransformer
+from sklearn.cluster import MiniBatchKMeans
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
+from google_auth_httplib2 import AuthorizedHttp
 from google_auth_oauthlib.flow import InstalledAppFlow
 from google.auth.transport.requests import Request
+from google.oauth2.credentials import Credentials
 
 # Gmail API scopes
 SCOPES = ['https://www.googleapis.com/auth/gmail.readonly']
 
+# Saved OAuth credentials, reused between runs
+TOKEN_FILE = 'token.json'
+
+# Unread emails, excluding spam and archived emails
+UNREAD_QUERY = 'is:unread in:inbox -in:spam'
+
+# Message IDs are listed in date-range shards fetched concurrently: the
+# last LIST_SHARD_DAYS days are split evenly, and one final shard covers
+# everything older
+LIST_SHARDS = 8
+LIST_SHARD_DAYS = 365
+
+# Maximum number of calls Gmail accepts in a single batch request
+BATCH_LIMIT = 100
+
+# Batches in flight at once, kept low to stay under Gmail's per-user quota
+MAX_CONCURRENT_BATCHES = 8
+
+# Gmail allows 250 quota units per user per second; messages.list and
+# messages.get cost 5 each
+QUOTA_UNITS_PER_SECOND = 250
+LIST_QUOTA_COST = 5
+GET_QUOTA_COST = 5
+
+# Gmail signals rate limiting with 429, or with 403 and one of these
+# reasons (other 403s, such as missing permissions or an exhausted daily
+# quota, won't succeed on retry), and how often to retry them
+RATE_LIMIT_REASONS = ('rateLimitExceeded', 'userRateLimitExceeded', 'RATE_LIMIT_EXCEEDED')
+MAX_RETRIES = 5
+
+# Columns of the email table returned by get_all_unread_emails
+EMAIL_FIELDS = ('ids', 'thread_ids', 'froms', 'subjects', 'dates', 'has_body')
+
+# File that stream mode writes fetched emails to, and its columns (one per
+# EMAIL_FIELDS entry)
+STREAM_FILE = 'unread_emails.csv'
+STREAM_COLUMNS = ('Id', 'Thread Id', 'From', 'Subject', 'Date', 'Has Body')
+
+# Rows of the stream file processed at a time when writing categories
+STREAM_CHUNK_SIZE = 10000
+
+# Columns of the categorized email CSV
+OUTPUT_COLUMNS = ('Category', 'From', 'Subject', 'Date', 'Has Body')
+
+# Headers requested for each message
+METADATA_HEADERS = ('From', 'Subject', 'Date')
+
+# On-disk cache of message metadata, keyed by message ID
+CACHE_FILE = 'email_cache.db'
+
+# Message IDs per cache lookup, under SQLite's bound-parameter limit
+CACHE_QUERY_LIMIT = 500
+
+# Socket timeout, in seconds, for Gmail API connections
+HTTP_TIMEOUT = 30
+
+_thread_local = threading.local()
+
+# Subject tokenizer shared by the vectorizers, compiled once at import
+# (same pattern as scikit-learn's default token_pattern)
+_tokenize = re.compile(r"(?u)\b\w\w+\b").findall
+
+class TokenBucket:
+    """Thread-safe token-bucket rate limiter for Gmail quota units."""
+    
+    def __init__(self, capacity=QUOTA_UNITS_PER_SECOND, refill_rate=QUOTA_UNITS_PER_SECOND):
+        self.capacity = capacity
+        self.refill_rate = refill_rate
+        self._tokens = capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+    
+    def consume(self, cost):
+        """Block until enough tokens are available, then take `cost` of them.
+        
+        A cost larger than the bucket leaves it in debt, so later callers
+        wait for the overdraft to refill.
+        """
+        needed = min(cost, self.capacity)
+        with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.capacity,
+                                   self._tokens + (now - self._updated) * self.refill_rate)
+                self._updated = now
+                if self._tokens >= needed:
+                    self._tokens -= cost
+                    return
+                time.sleep((needed - self._tokens) / self.refill_rate)
+
+def _is_rate_limited(error):
+    """Check whether an HttpError is Gmail asking us to slow down."""
+    if error.resp.status == 429:
+        return True
+    if error.resp.status != 403:
+        return False
+    details = getattr(error, 'error_details', None)
+    if not isinstance(details, list):
+        return False
+    return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS
+               for detail in details)
+
+def _backoff_delay(retry):
+    """Exponential backoff with jitter for rate-limited requests."""
+    return min(2 ** retry, 32) + random.random()
+
+def _execute_with_retry(request, creds, bucket, cost):
+    """Execute a request on this thread's HTTP client, retrying with backoff while rate limited."""
+    for retry in range(MAX_RETRIES + 1):
+        bucket.consume(cost)
+        try:
+            return request.execute(http=_thread_http(creds))
+        except HttpError as error:
+            if not _is_rate_limited(error) or retry == MAX_RETRIES:
+                raise
+            time.sleep(_backoff_delay(retry))
+
 def authenticate_gmail():
-    """Authenticate with Gmail API and return the service object."""
+    """Authenticate with Gmail API and return the service object and its credentials."""
     creds = None
     
-    # Check if token.pickle exists
-    if os.path.exists('token.pickle'):
-        with open('token.pickle', 'rb') as token:
-            creds = pickle.load(token)
+    # Check if token.json exists
+    if os.path.exists(TOKEN_FILE):
+        with open(TOKEN_FILE, 'r', encoding='utf-8') as token:
+            creds = Credentials.from_authorized_user_info(json.load(token), SCOPES)
     
     # If credentials are invalid or don't exist, let the user log in
     if not creds or not creds.valid:
@@ -45,18 +178,26 @@ def authenticate_gmail():
             )
             creds = flow.credentials
         
-        # Save the credentials for the next run
-        with open('token.pickle', 'wb') as token:
-            pickle.dump(creds, token)
+        # Save the credentials for the next run, swapping the file in
+        # atomically so an interrupted write can't corrupt it
+        tmp_file = TOKEN_FILE + '.tmp'
+        with open(tmp_file, 'w', encoding='utf-8') as token:
+            token.write(creds.to_json())
+        os.replace(tmp_file, TOKEN_FILE)
     
-    # Build and return the Gmail service
-    return build('gmail', 'v1', credentials=creds)
+    # Build and return the Gmail service on a persistent HTTP client so
+    # requests reuse the same keep-alive connection
+    return build('gmail', 'v1', http=_authorized_http(creds)), creds
+
+def _authorized_http(creds):
+    """Create an HTTP client that signs requests with `creds`."""
+    return AuthorizedHttp(creds, http=httplib2.Http(timeout=HTTP_TIMEOUT))
 
 def get_unread_email_count(service, user_id='me'):
     """Get the total count of unread emails, excluding spam and archived emails."""
     response = service.users().messages().list(
         userId=user_id,
-        q='is:unread in:inbox -in:spam',
+        q=UNREAD_QUERY,
         maxResults=1
     ).execute()
     
@@ -64,185 +205,410 @@ def get_unread_email_count(service, user_id='me'):
     total = response.get('resultSizeEstimate', 0)
     return total
 
-def get_all_unread_emails(service, user_id='me', batch_size=25) -> List[Dict[str, Any]]:
-    """Fetch all unread emails from Gmail with progress indicator, excluding spam and archived emails."""
+def _open_cache(path=CACHE_FILE):
+    """Open the message metadata cache, creating its table on first use."""
+    conn = sqlite3.connect(path)
+    conn.execute(
+        'CREATE TABLE IF NOT EXISTS emails ('
+        'id TEXT PRIMARY KEY, thread_id TEXT, from_ TEXT, subject TEXT, '
+        'date TEXT, has_body INTEGER)'
+    )
+    return conn
+
+def _query_cache(conn, columns, message_ids):
+    """Yield the given cache columns for the given message IDs, one query's rows at a time."""
+    for i in range(0, len(message_ids), CACHE_QUERY_LIMIT):
+        chunk = message_ids[i:i + CACHE_QUERY_LIMIT]
+        placeholders = ','.join('?' * len(chunk))
+        yield conn.execute(
+            f'SELECT {columns} FROM emails WHERE id IN ({placeholders})', chunk).fetchall()
+
+def _iter_cached(conn, message_ids):
+    """Yield lists of cached email rows for the given message IDs."""
+    for rows in _query_cache(conn, 'id, thread_id, from_, subject, date, has_body', message_ids):
+        yield [row[:-1] + (bool(row[-1]),) for row in rows]
+
+def _load_cached(conn, message_ids) -> Dict[str, Tuple]:
+    """Return cached email rows for the given message IDs, keyed by ID."""
+    return {row[0]: row for rows in _iter_cached(conn, message_ids) for row in rows}
+
+def _cached_ids(conn, message_ids) -> set:
+    """Return which of the given message IDs are in the cache, without loading their rows."""
+    return {row[0] for rows in _query_cache(conn, 'id', message_ids) for row in rows}
+
+def _save_to_cache(conn, rows):
+    """Store email rows in the cache in a single transaction."""
+    with conn:
+        conn.executemany('INSERT OR REPLACE INTO emails VALUES (?, ?, ?, ?, ?, ?)', rows)
+
+def _thread_http(creds):
+    """Return an HTTP client authorized with `creds` and owned by the calling thread.
+    
+    httplib2 connections are not thread-safe, so each worker thread gets its
+    own client. Pool threads are reused, so each client keeps its connection
+    alive across requests.
+    """
+    http = getattr(_thread_local, 'http', None)
+    if http is None:
+        http = _authorized_http(creds)
+        _thread_local.http = http
+    return http
+
+def _shard_queries(now=None, shards=LIST_SHARDS, days=LIST_SHARD_DAYS) -> List[str]:
+    """Split UNREAD_QUERY into date-range queries, newest first."""
+    now = int(time.time()) if now is None else now
+    step = days * 86400 // (shards - 1)
+    edges = [None] + [now - i * step for i in range(1, shards)] + [None]
+    
+    queries = []
+    for before, after in zip(edges, edges[1:]):
+        query = UNREAD_QUERY
+        if after is not None:
+            # Overlap neighbouring shards by a second so nothing falls
+            # between them; duplicates are dropped when merging
+            query += f' after:{after - 1}'
+        if before is not None:
+            query += f' before:{before}'
+        queries.append(query)
+    return queries
+
+async def _list_shard(service, creds, user_id, query, bucket) -> List[str]:
+    """List the IDs of all messages matching one shard query."""
+    message_ids = []
+    next_page_token = None
+    
+    # Pages within a shard are sequential since each needs the previous token
+    while True:
+        request = service.users().messages().list(
+            userId=user_id,
+            q=query,
+            pageToken=next_page_token,
+            maxResults=100  # Maximum allowed by Gmail API
+        )
+        
+        response = await asyncio.to_thread(
+            _execute_with_retry, request, creds, bucket, LIST_QUOTA_COST)
+        message_ids.extend(message['id'] for message in response.get('messages', []))
+        
+        next_page_token = response.get('nextPageToken')
+        if not next_page_token:
+            return message_ids
+
+def _metadata_request(service, user_id, message_id):
+    """Build the messages.get request for the headers we categorize on."""
+    return service.users().messages().get(
+        userId=user_id, id=message_id, format='metadata',
+        metadataHeaders=list(METADATA_HEADERS),
+        # Only ask for what _parse_message reads to keep responses small
+        fields='id,threadId,snippet,payload/headers'
+    )
+
+def _parse_message(msg) -> Tuple:
+    """Extract one email row, in EMAIL_FIELDS order, from a messages.get response."""
+    # metadataHeaders already limits the response to the headers we asked
+    # for, so one pass builds the lookup without filtering names
+    headers = {h['name']: h['value'] for h in msg['payload']['headers']}
+    
+    # Check if the email has a body by looking at the snippet
+    # If snippet is not blank, the email has some content (isspace scans
+    # in C without building a stripped copy)
+    snippet = msg.get('snippet', '')
+    has_body = bool(snippet) and not snippet.isspace()
+    
+    return (msg['id'], msg['threadId'], headers.get('From', 'Unknown'),
+            headers.get('Subject', ''), headers.get('Date', 'Unknown'), has_body)
+
+def _to_columns(rows) -> Dict[str, Any]:
+    """Transpose email rows into a dict of columns keyed by EMAIL_FIELDS."""
+    columns = [list(column) for column in zip(*rows)] or [[] for _ in EMAIL_FIELDS]
+    emails = dict(zip(EMAIL_FIELDS, columns))
+    emails['has_body'] = np.array(emails['has_body'], dtype=bool)
+    return emails
+
+def _to_frame(emails) -> pd.DataFrame:
+    """Build the output table (one row per categorized email) from email columns."""
+    df = pd.DataFrame({
+        'Category': emails['categories'],
+        'From': emails['froms'],
+        'Subject': emails['subjects'],
+        'Date': emails['dates'],
+        'Has Body': emails['has_body']
+    })
+    df['Subject'] = df['Subject'].replace('', 'No subject')
+    return df
+
+async def _fetch_individually(service, creds, user_id, message_ids, pool, bucket) -> Dict[str, Tuple]:
+    """Fetch messages one request each, concurrently on the thread pool.
+    
+    Used when Gmail refuses the batch endpoint itself.
+    """
+    loop = asyncio.get_running_loop()
+    
+    def _fetch(message_id):
+        return _execute_with_retry(
+            _metadata_request(service, user_id, message_id), creds, bucket, GET_QUOTA_COST)
+    
+    responses = await asyncio.gather(
+        *[loop.run_in_executor(pool, _fetch, message_id) for message_id in message_ids],
+        return_exceptions=True
+    )
+    
+    results = {}
+    for message_id, response in zip(message_ids, responses):
+        if isinstance(response, Exception):
+            print(f"Failed to fetch email {message_id}: {response}")
+        else:
+            results[message_id] = _parse_message(response)
+    return results
+
+async def _fetch_chunk(service, creds, user_id, message_ids, semaphore, pool, bucket) -> Dict[str, Tuple]:
+    """Fetch one chunk of messages with a single batch request."""
+    async with semaphore:
+        results = {}
+        pending = list(message_ids)
+        retry = 0
+        while pending:
+            throttled = []
+            
+            def _collect(request_id, response, exception):
+                """Batch callback: parse a single message response."""
+                if exception is None:
+                    results[request_id] = _parse_message(response)
+                elif isinstance(exception, HttpError) and _is_rate_limited(exception):
+                    throttled.append(request_id)
+                else:
+                    print(f"Failed to fetch email {request_id}: {exception}")
+            
+            batch = service.new_batch_http_request(callback=_collect)
+            for message_id in pending:
+                batch.add(_metadata_request(service, user_id, message_id), request_id=message_id)
+            
+            def _execute():
+                bucket.consume(GET_QUOTA_COST * len(pending))
+                batch.execute(http=_thread_http(creds))
+            
+            try:
+                await asyncio.to_thread(_execute)
+            except HttpError as error:
+                if _is_rate_limited(error):
+                    # The whole batch was rate limited, so retry all of it
+                    throttled = list(pending)
+                elif error.resp.status == 503:
+                    # Batch endpoint unavailable, fall back to individual requests
+                    print(f"Batch request unavailable, fetching {len(pending)} emails individually...")
+                    results.update(await _fetch_individually(service, creds, user_id, pending, pool, bucket))
+                    break
+                else:
+                    raise
+            
+            # Only back off when Gmail actually rate limited us, and retry
+            # the throttled messages
+            if throttled:
+                if retry == MAX_RETRIES:
+                    print(f"Giving up on {len(throttled)} rate-limited emails.")
+                    break
+                delay = _backoff_delay(retry)
+                print(f"Rate limited on {len(throttled)} emails, retrying in {delay:.1f}s...")
+                await asyncio.sleep(delay)
+                retry += 1
+            pending = throttled
+        
+        print(f"Fetched {len(results)}/{len(message_ids)} emails in batch")
+        return results
+
+async def _fetch_new_emails(service, creds, user_id, message_ids, batch_size, bucket, cache):
+    """Fetch emails in concurrent batches, yielding each chunk's rows as it completes.
+    
+    Every chunk is stored in the cache before it is yielded.
+    """
+    semaphore = asyncio.Semaphore(MAX_CONCURRENT_BATCHES)
+    with ThreadPoolExecutor(max_workers=MAX_CONCURRENT_BATCHES) as pool:
+        chunks = [
+            asyncio.ensure_future(_fetch_chunk(
+                service, creds, user_id, message_ids[i:i + batch_size], semaphore, pool, bucket))
+            for i in range(0, len(message_ids), batch_size)
+        ]
+        try:
+            for next_chunk in asyncio.as_completed(chunks):
+                rows = await next_chunk
+                _save_to_cache(cache, rows.values())
+                yield rows
+        finally:
+            # If a chunk failed (or the caller stopped early), don't leave the
+            # remaining chunks running unobserved
+            for chunk in chunks:
+                chunk.cancel()
+            await asyncio.gather(*chunks, return_exceptions=True)
+
+async def get_all_unread_emails(service, creds, user_id='me', batch_size=BATCH_LIMIT,
+                                stream=False, stream_file=STREAM_FILE):
+    """Fetch all unread emails from Gmail with progress indicator, excluding spam and archived emails.
+    
+    `creds` are the credentials `service` was built with; worker threads
+    use them to open their own connections.
+    
+    Returns a dict of parallel columns keyed by EMAIL_FIELDS. With
+    `stream=True`, rows are instead written to `stream_file` as each batch
+    completes and the number of emails written is returned.
+    """
     try:
         # First, get the total count of unread emails
         total_count = get_unread_email_count(service, user_id)
         print(f"Total unread emails (excluding spam and archived): {total_count}")
         
-        # Get list of unread messages
-        all_messages = []
-        next_page_token = None
+        bucket = TokenBucket()
         
-        # Keep fetching pages until we have all messages
-        page_count = 0
-        while True:
-            page_count += 1
-            print(f"Fetching page {page_count} of unread emails...")
-            response = service.users().messages().list(
-                userId=user_id, 
-                q='is:unread in:inbox -in:spam',
-                pageToken=next_page_token,
-                maxResults=100  # Maximum allowed by Gmail API
-            ).execute()
-            
-            messages = response.get('messages', [])
-            if not messages:
-                break
-                
-            all_messages.extend(messages)
-            
-            print(f"Fetched message IDs: {len(all_messages)}/{total_count}")
-            
-            # Check if there are more pages
-            next_page_token = response.get('nextPageToken')
-            if not next_page_token:
-                break
-                
-            # Safety check - if we've fetched more than expected, stop
-            if len(all_messages) >= total_count * 1.1:  # Allow 10% margin for error
-                print("Reached expected number of unread emails. Stopping fetch.")
-                break
+        # List unread message IDs, with the date-range shards paging in parallel
+        queries = _shard_queries()
+        print(f"Listing unread emails in {len(queries)} date ranges...")
+        shards = await asyncio.gather(*[
+            _list_shard(service, creds, user_id, query, bucket) for query in queries
+        ])
+        
+        # Merge newest first, dropping duplicates from overlapping shard edges
+        message_ids = list(dict.fromkeys(
+            message_id for shard in shards for message_id in shard))
+        print(f"Fetched message IDs: {len(message_ids)}/{total_count}")
         
-        if not all_messages:
+        if not message_ids:
             print("No unread messages found.")
-            return []
+            return 0 if stream else _to_columns([])
             
-        # Fetch full message details for each unread message
-        emails = []
-        total_messages = len(all_messages)
+        # Fetch message details in batches so each HTTP call covers up to
+        # BATCH_LIMIT messages, running several batches at once
+        print(f"Processing {len(message_ids)} unread emails...")
         
-        print(f"Processing {total_messages} unread emails...")
-        
-        for i, message in enumerate(all_messages):
-            if i % 10 == 0:
-                print(f"Processing email {i+1}/{total_messages}...")
-            
-            msg = service.users().messages().get(
-                userId=user_id, id=message['id'], format='metadata',
-                metadataHeaders=['From', 'Subject', 'Date']
-            ).execute()
-            
-            # Extract email data
-            email_data = {}
-            email_data['id'] = msg['id']
-            email_data['threadId'] = msg['threadId']
-            
-            # Get headers
-            headers = msg['payload']['headers']
-            for header in headers:
-                if header['name'] == 'From':
-                    email_data['from'] = header['value']
-                if header['name'] == 'Subject':
-                    email_data['subject'] = header['value']
-                if header['name'] == 'Date':
-                    email_data['date'] = header['value']
-            
-            # Check if the email has a body by looking at the snippet
-            # If snippet is not empty, the email has some content
-            has_body = bool(msg.get('snippet', '').strip())
-            email_data['has_body'] = has_body
+        with closing(_open_cache()) as cache:
+            # Metadata never changes, so only fetch emails we haven't seen
+            # before. Stream mode only looks up which IDs are cached, so
+            # cached rows never all sit in memory at once.
+            if stream:
+                cached = _cached_ids(cache, message_ids)
+            else:
+                cached = rows_by_id = _load_cached(cache, message_ids)
+            uncached_ids = [message_id for message_id in message_ids
+                            if message_id not in cached]
+            print(f"Found {len(cached)} emails in cache, fetching {len(uncached_ids)}...")
             
-            # Skip body content for faster processing
-            email_data['body'] = ''
+            new_emails = _fetch_new_emails(service, creds, user_id, uncached_ids, batch_size, bucket, cache)
             
-            emails.append(email_data)
+            if stream:
+                # Write rows out as they are read or arrive instead of collecting them
+                with open(stream_file, 'w', encoding='utf-8', newline='') as csvfile:
+                    writer = csv.writer(csvfile)
+                    writer.writerow(STREAM_COLUMNS)
+                    count = 0
+                    
+                    cached_ids = [message_id for message_id in message_ids if message_id in cached]
+                    for rows in _iter_cached(cache, cached_ids):
+                        writer.writerows(rows)
+                        count += len(rows)
+                    
+                    async for rows in new_emails:
+                        writer.writerows(rows.values())
+                        count += len(rows)
+                
+                print(f"Saved {count} emails to {stream_file}")
+                return count
             
-            # Add a small delay to avoid rate limiting
-            if (i + 1) % batch_size == 0 and i < total_messages - 1:
-                print(f"Pausing briefly to avoid rate limits...")
-                time.sleep(1)
+            async for rows in new_emails:
+                rows_by_id.update(rows)
         
-        return emails
+        # Keep the order returned by messages.list
+        return _to_columns([rows_by_id[message_id] for message_id in message_ids
+                            if message_id in rows_by_id])
     
     except Exception as error:
         print(f'An error occurred: {error}')
-        return []
+        return 0 if stream else _to_columns([])
 
-def suggest_categories(emails: List[Dict[str, Any]], num_clusters=5):
-    """Suggest categories for emails using clustering."""
-    if not emails:
+def suggest_categories(subjects: List[str], num_clusters=5) -> List[str]:
+    """Suggest a category for each email subject using clustering."""
+    if not subjects:
         return []
     
     # Use subject for categorization since we're skipping body content
-    documents = []
-    for email in emails:
-        subject = email.get('subject', '')
-        documents.append(subject)
-    
-    # Extract features with TF-IDF
-    vectorizer = TfidfVectorizer(
+    # Count words in a single tokenizing pass; the counts are TF-IDF
+    # weighted for clustering and reused to name the clusters. Features
+    # stay a sparse float32 CSR matrix that is never densified.
+    vectorizer = CountVectorizer(
         max_features=100,
         stop_words='english',
+        tokenizer=_tokenize,
+        token_pattern=None,
         min_df=1,  # Changed from 2 to 1 to work with fewer documents
-        max_df=0.9  # Changed from 0.8 to 0.9 to be more inclusive
+        max_df=0.9,  # Changed from 0.8 to 0.9 to be more inclusive
+        dtype=np.float32
     )
     
+    # Inboxes repeat many subjects, so vectorize and cluster each distinct
+    # subject once, weighted by how often it occurs. factorize hashes the
+    # subjects, avoiding a sort and fixed-width padding to the longest one.
+    inverse, unique_subjects = pd.factorize(pd.Series(subjects, dtype=object))
+    occurrences = np.bincount(inverse)
+    
     # If we have too few documents, adjust the clustering
-    if len(documents) < num_clusters:
-        num_clusters = max(2, len(documents) // 2)
+    if len(subjects) < num_clusters:
+        num_clusters = max(2, len(subjects) // 2)
+    num_clusters = min(num_clusters, len(unique_subjects))
     
     try:
-        X = vectorizer.fit_transform(documents)
+        counts = vectorizer.fit_transform(unique_subjects)
+        X = TfidfTransformer().fit_transform(counts)
         
-        # Perform KMeans clustering
-        kmeans = KMeans(n_clusters=num_clusters, random_state=42)
-        kmeans.fit(X)
+        # Perform KMeans clustering over minibatches of subjects
+        kmeans = MiniBatchKMeans(
+            n_clusters=num_clusters,
+            batch_size=256,
+            n_init='auto',
+            random_state=42
+        )
+        kmeans.fit(X, sample_weight=occurrences)
         
-        # Get cluster assignments
-        clusters = kmeans.labels_
+        # Get cluster assignments for each distinct subject
+        labels = kmeans.labels_
         
-        # Get important features for each cluster
+        # Total the word counts per cluster to find important words
         feature_names = vectorizer.get_feature_names_out()
-        cluster_centers = kmeans.cluster_centers_
+        membership = csr_matrix(
+            (occurrences, (labels, np.arange(len(labels)))),
+            shape=(num_clusters, len(labels))
+        )
+        cluster_word_counts = (membership @ counts).toarray()
         
-        # Create a category name for each cluster based on important words
-        categories = []
-        for i in range(num_clusters):
-            # Get indices of top 3 words for this cluster
-            top_indices = cluster_centers[i].argsort()[-3:][::-1]
-            top_words = [feature_names[idx] for idx in top_indices if idx < len(feature_names)]
-            if not top_words:  # If no words were found
-                category_name = f"Category {i+1}"
-            else:
-                category_name = f"Category {i+1}: {', '.join(top_words)}"
-            categories.append(category_name)
+        # Get indices of the top 3 words for every cluster at once, ordered
+        # by count, without fully sorting each row
+        top_k = min(3, cluster_word_counts.shape[1])
+        top_idx = np.argpartition(cluster_word_counts, -top_k, axis=1)[:, -top_k:]
+        top_counts = np.take_along_axis(cluster_word_counts, top_idx, axis=1)
+        order = np.argsort(-top_counts, axis=1)
+        top_idx = np.take_along_axis(top_idx, order, axis=1)
+        top_counts = np.take_along_axis(top_counts, order, axis=1)
         
-        # Assign category to each email
-        for i, email in enumerate(emails):
-            email['category'] = categories[clusters[i]]
+        # Look up every cluster's top words in one gather, shape (K, top_k),
+        # skipping words that never appear in a cluster
+        top_words = feature_names[top_idx]
+        found = top_counts > 0
         
-        return emails
+        # Create a category name for each cluster based on important words
+        categories = [
+            f"Category {i+1}: {', '.join(top_words[i][found[i]])}" if found[i].any()
+            else f"Category {i+1}"  # If no words were found
+            for i in range(num_clusters)
+        ]
+        
+        # Assign category to each email by scattering subject labels back
+        return [categories[cluster] for cluster in labels[inverse]]
     
     except Exception as e:
         print(f"Error in categorization: {e}")
         # If clustering fails, assign a default category
-        for email in emails:
-            email['category'] = "Uncategorized"
-        return emails
+        return ["Uncategorized"] * len(subjects)
 
-def save_categories_to_file(categories, filename="email_categories.csv"):
-    """Save categorized emails to a CSV file."""
+def save_categories_to_file(df, filename="email_categories.csv"):
+    """Save categorized emails to a CSV file, in the frame's row order."""
     try:
-        with open(filename, 'w', encoding='utf-8', newline='') as csvfile:
-            # Create CSV writer
-            fieldnames = ['Category', 'From', 'Subject', 'Date', 'Has Body']
-            writer = csv.DictWriter(csvfile, fieldnames=fieldnames)
-            
-            # Write header with note about excluded emails
-            writer.writeheader()
-            
-            # Write data
-            for category, emails in categories.items():
-                for email in emails:
-                    writer.writerow({
-                        'Category': category,
-                        'From': email.get('from', 'Unknown'),
-                        'Subject': email.get('subject', 'No subject'),
-                        'Date': email.get('date', 'Unknown'),
-                        'Has Body': email.get('has_body', False)
-                    })
+        df.to_csv(filename, index=False, encoding='utf-8')
                     
         print(f"Categories saved to {filename}")
         return True
@@ -250,46 +616,116 @@ def save_categories_to_file(categories, filename="email_categories.csv"):
         print(f"Error saving to file: {e}")
         return False
 
+def save_streamed_categories(email_categories, stream_file=STREAM_FILE,
+                             filename="email_categories.csv", chunksize=STREAM_CHUNK_SIZE):
+    """Save streamed emails with their categories to a CSV file, grouped by category.
+    
+    `stream_file` is read one chunk at a time and each category's rows are
+    spooled to their own temporary file, so the full table is never held
+    in memory. Returns (category, email count, first 3 emails) for each
+    category in first-seen order, or an empty list if saving failed.
+    """
+    try:
+        with ExitStack() as stack:
+            spools, counts, samples = {}, {}, {}
+            start = 0
+            for chunk in pd.read_csv(stream_file, usecols=list(OUTPUT_COLUMNS[1:]), dtype=str,
+                                     keep_default_na=False, chunksize=chunksize):
+                chunk.insert(0, 'Category', email_categories[start:start + len(chunk)])
+                start += len(chunk)
+                chunk['Subject'] = chunk['Subject'].replace('', 'No subject')
+                
+                for category, group in chunk.groupby('Category', sort=False):
+                    if category not in spools:
+                        spools[category] = stack.enter_context(
+                            tempfile.TemporaryFile('w+', encoding='utf-8', newline=''))
+                        counts[category] = 0
+                        samples[category] = group.head(0)
+                    if counts[category] < 3:
+                        samples[category] = pd.concat(
+                            [samples[category], group.head(3 - counts[category])])
+                    counts[category] += len(group)
+                    group.to_csv(spools[category], header=False, index=False)
+            
+            # Write the header, then each category's rows back to back
+            with open(filename, 'w', encoding='utf-8', newline='') as csvfile:
+                pd.DataFrame(columns=list(OUTPUT_COLUMNS)).to_csv(csvfile, index=False)
+                for spool in spools.values():
+                    spool.seek(0)
+                    shutil.copyfileobj(spool, csvfile)
+        
+        print(f"Categories saved to {filename}")
+        return [(category, counts[category], samples[category]) for category in spools]
+    except Exception as e:
+        print(f"Error saving to file: {e}")
+        return []
+
+def _print_categories(summary):
+    """Print each (category, email count, first emails) entry of a category summary."""
+    print("\n===== Email Categories =====")
+    for category, count, first_emails in summary:
+        print(f"\n{category} ({count} emails):")
+        for sender, subject, date in first_emails[['From', 'Subject', 'Date']].itertuples(index=False):
+            print(f"  - From: {sender}")
+            print(f"    Subject: {subject}")
+            print(f"    Date: {date}")
+            print()
+        if count > 3:
+            print(f"  ... and {count - 3} more emails in this category.")
+
 def main():
     """Main function to fetch and categorize emails."""
+    parser = argparse.ArgumentParser(description="Fetch unread Gmail emails and categorize them.")
+    parser.add_argument(
+        '--stream', action='store_true',
+        help=f"write emails to {STREAM_FILE} as they are fetched instead of keeping them in memory"
+    )
+    args = parser.parse_args()
+    
     print("Authenticating with Gmail...")
-    service = authenticate_gmail()
+    service, creds = authenticate_gmail()
     
     print("\nFetching all unread emails (excluding spam and archived)...")
-    emails = get_all_unread_emails(service)
+    if args.stream:
+        count = asyncio.run(get_all_unread_emails(service, creds, stream=True))
+    else:
+        emails = asyncio.run(get_all_unread_emails(service, creds))
+        count = len(emails['ids'])
     
-    if not emails:
+    if not count:
         print("No unread emails to analyze.")
         return
     
-    print(f"\nFound {len(emails)} unread emails (excluding spam and archived).")
+    print(f"\nFound {count} unread emails (excluding spam and archived).")
     
     print("\nCategorizing emails...")
-    categorized_emails = suggest_categories(emails)
-    
-    # Group emails by category
-    categories = {}
-    for email in categorized_emails:
-        category = email['category']
-        if category not in categories:
-            categories[category] = []
-        categories[category].append(email)
+    if args.stream:
+        # Cluster using only the subject column, then write the categorized
+        # emails back out chunk by chunk
+        subjects = pd.read_csv(STREAM_FILE, usecols=['Subject'], dtype=str,
+                               keep_default_na=False)['Subject'].tolist()
+        email_categories = suggest_categories(subjects)
+        del subjects
+        summary = save_streamed_categories(email_categories)
+    else:
+        emails['categories'] = suggest_categories(emails['subjects'])
+        
+        # Group emails by category once, keeping categories in first-seen order
+        df = _to_frame(emails)
+        groups = df.groupby('Category', sort=False)
+        
+        # Only show first 3 emails per category in console
+        sizes = groups.size()
+        summary = [(category, sizes[category], first_emails)
+                   for category, first_emails in groups.head(3).groupby('Category', sort=False)]
+        
+        # Save results to file, grouped by category; the stable sort keeps
+        # emails in their original order within each category
+        order = np.argsort(groups.ngroup().to_numpy(), kind='stable')
+        save_categories_to_file(df.iloc[order])
     
     # Display results
-    print("\n===== Email Categories =====")
-    for category, emails in categories.items():
-        print(f"\n{category} ({len(emails)} emails):")
-        for i, email in enumerate(emails):
-            if i < 3:  # Only show first 3 emails per category in console
-                print(f"  - From: {email.get('from', 'Unknown')}")
-                print(f"    Subject: {email.get('subject', 'No subject')}")
-                print(f"    Date: {email.get('date', 'Unknown')}")
-                print()
-        if len(emails) > 3:
-            print(f"  ... and {len(emails) - 3} more emails in this category.")
-    
-    # Save results to file
-    save_categories_to_file(categories)
+    _print_categories(summary)
     print(f"\nAll categorized emails have been saved to email_categories.csv")
 
 if __name__ == "__main__":